@@ -1,49 +1,76 @@
 import streamlit as st
+import hashlib
 import os
 import tempfile
+import threading
+import time
 from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, HumanMessage
 # Import your custom modules
-from rag_engine import process_document_to_chroma, get_rag_chain, format_docs
-from ui_components import apply_custom_styles, render_header, render_sidebar_capabilities
+from rag_engine import (
+    process_document_to_chroma, has_persisted_chroma, load_persisted_chroma, get_rag_chain, format_docs,
+    get_embeddings, get_llm
+)
+from ui_components import apply_custom_styles, render_header, render_sidebar_capabilities, render_sources
 
 load_dotenv()
+
+CHROMA_ROOT = "./chroma_db"
+
 # Initialize a session ID to track resets
 if "id" not in st.session_state:
     st.session_state.id = 0
 
+def warm_up_models():
+    """Loads the embedding model and opens the Groq connection ahead of use."""
+    get_embeddings()
+    try:
+        # One-token completion: enough to pool the connection, cheap to bill
+        get_llm().bind(max_tokens=1).invoke("ping")
+    except Exception as e:
+        print(f"⚠️ LLM warm-up failed: {e}")
+
+@st.cache_resource(show_spinner=False)
+def start_warm_up():
+    """Starts the warm-up thread once per process, not once per session."""
+    thread = threading.Thread(target=warm_up_models, daemon=True)
+    thread.start()
+    return thread
+
+# Warm up in the background while the user picks a file
+start_warm_up()
+
+def buffer_stream(stream, max_chars=8192, max_ms=25):
+    """Groups streamed tokens so the UI redraws per window, not per token."""
+    buf = []
+    buf_len = 0
+    started = time.monotonic()
+    for token in stream:
+        buf.append(token)
+        buf_len += len(token)
+        if buf_len >= max_chars or (time.monotonic() - started) * 1000 >= max_ms:
+            yield "".join(buf)
+            buf.clear()
+            buf_len = 0
+            started = time.monotonic()
+    if buf:
+        yield "".join(buf)
+
 def reset_application():
-    """Wipes the DB data and resets the session."""
+    """Drops this session's document and chat, keeping shared caches on disk."""
     
-    # 1. Logical Wipe 
+    # 1. Release the store. Persisted stores are keyed by content hash and
+    # may be open in other sessions that uploaded the same PDF, so they are
+    # left in place; old unused stores are evicted when new ones are built.
     if "vectorstore" in st.session_state:
-        try:
-            # Delete all documents in the collection
-            st.session_state.vectorstore.delete_collection()
-            st.toast("Database cleared successfully")
+        del st.session_state.vectorstore
+        st.toast("Session cleared successfully")
 
-        except Exception as e:
-            st.toast(f"⚠️ Error clearing collection: {e}")
-        
-        # NOW we can remove the reference from memory
-        del st.session_state.vectorstore 
-    
-    # 2. Physical Wipe (Optional Backup)
-    # We try to delete the folder, but if Windows blocks it, we ignore it.
-    # Since we already emptied the DB in Step 1, it doesn't matter if the folder stays!
-    # if os.path.exists("./chroma_db"):
-    #     try:
-    #         shutil.rmtree("./chroma_db")
-    #         print("✅ Folder deleted.")
-    #     except PermissionError:
-    #         print("🔒 Windows locked the folder. Keeping empty folder (safe).")
-    #     except Exception as e:
-    #         print(f"⚠️ Other deletion error: {e}")
-
-    # 3. Clear History
+    # 2. Clear History
     st.session_state.chat_history = []
+    st.session_state.turn_sources = {}
     
-    # 4. Force UI Reset
+    # 3. Force UI Reset
     st.session_state.id += 1 
     
     st.rerun()
@@ -58,6 +85,10 @@ render_header()
 # 3. Session State Init
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+# Source snippets per assistant turn, keyed by chat_history index, so reruns
+# redraw them without touching the retrieved documents again
+if "turn_sources" not in st.session_state:
+    st.session_state.turn_sources = {}
 
 # 4. Sidebar Logic
 with st.sidebar:
@@ -74,28 +105,49 @@ with st.sidebar:
         reset_application()
         
     if uploaded_file and "vectorstore" not in st.session_state:
-        with st.spinner("Processing PDF..."):
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                tmp_file.write(uploaded_file.read())
-                tmp_path = tmp_file.name
-            
-            # Process using your backend engine
-            st.session_state.vectorstore = process_document_to_chroma(tmp_path)
-            st.success("Report Indexed Successfully!")
-            os.remove(tmp_path)
+        file_bytes = uploaded_file.getvalue()
+        # Identical files map to the same store, so re-uploads skip indexing
+        doc_hash = hashlib.sha256(file_bytes).hexdigest()[:16]
+        persist_dir = os.path.join(CHROMA_ROOT, doc_hash)
+
+        if has_persisted_chroma(persist_dir):
+            st.session_state.vectorstore = load_persisted_chroma(persist_dir)
+            st.success("Report loaded from cache!")
+        else:
+            with st.spinner("Processing PDF..."):
+                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+                    tmp_file.write(file_bytes)
+                    tmp_path = tmp_file.name
+                
+                # Process using your backend engine
+                # (a store left half-built by a crash, or built by an older
+                # pipeline, has no matching completion marker and is rebuilt)
+                try:
+                    st.session_state.vectorstore = process_document_to_chroma(
+                        tmp_path, persist_directory=persist_dir
+                    )
+                finally:
+                    os.remove(tmp_path)
+                st.success("Report Indexed Successfully!")
     
     # Render static sidebar text
     render_sidebar_capabilities()
 
 # 5. Render Existing Chat History
-for message in st.session_state.chat_history:
+for turn, message in enumerate(st.session_state.chat_history):
     role = "assistant" if isinstance(message, AIMessage) else "user"
     with st.chat_message(role):
         st.markdown(message.content)
+        if turn in st.session_state.turn_sources:
+            render_sources(st.session_state.turn_sources[turn])
 
 # 6. Main Chat Loop
 if prompt := st.chat_input("Ask about the report..."):
     
+    # Prior turns only: the current prompt is passed separately as "input",
+    # and an empty history lets the retriever skip the LLM rewrite call
+    history = list(st.session_state.chat_history)
+
     # Display & Save User Message
     with st.chat_message("user"):
         st.markdown(prompt)
@@ -109,7 +161,7 @@ if prompt := st.chat_input("Ask about the report..."):
             # A. Retrieval
             with st.spinner("Analyzing document..."):
                 retrieved_docs = retriever_chain.invoke({
-                    "chat_history": st.session_state.chat_history,
+                    "chat_history": history,
                     "input": prompt
                 })
             
@@ -118,21 +170,20 @@ if prompt := st.chat_input("Ask about the report..."):
             
             stream_generator = generation_chain.stream({
                 "context": formatted_context,
-                "chat_history": st.session_state.chat_history,
+                "chat_history": history,
                 "input": prompt
             })
             
-            response_text = st.write_stream(stream_generator)
+            response_text = st.write_stream(buffer_stream(stream_generator))
             st.session_state.chat_history.append(AIMessage(content=response_text))
             
-            # C. Sources
-            with st.expander("View Sources"):
-                for i, doc in enumerate(retrieved_docs):
-                    st.markdown(f"**Source {i+1}**")
-                    page = doc.metadata.get("page", "Unknown")
-                    st.caption(f"Page: {page}")
-                    st.info(doc.page_content[:300] + "...")
-                    st.divider()
+            # C. Sources (built once, then reused on every rerun)
+            sources = [
+                (doc.metadata.get("page", "Unknown"), doc.page_content[:300] + "...")
+                for doc in retrieved_docs
+            ]
+            st.session_state.turn_sources[len(st.session_state.chat_history) - 1] = sources
+            render_sources(sources)
     else:
         st.error("Please upload a document first to start the analysis.")
 
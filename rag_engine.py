@@ -1,96 +1,292 @@
 """RAG Engine for financial document analysis using LangChain and Chroma."""
 
 import os
-from typing import List, Tuple
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+import numpy as np
+import streamlit as st
 from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
 from langchain_chroma import Chroma
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.retrievers import BaseRetriever
 from langchain_classic.chains.history_aware_retriever import create_history_aware_retriever
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+from pdf_chunking import iter_page_splits
 
 load_dotenv()
 
 if not os.getenv("GROQ_API_KEY"):
     raise ValueError("GROQ_API_KEY not found. Please check your .env file.")
 
-def process_document_to_chroma(uploaded_file_path: str):
-    """Load PDF, chunk intelligently, create Chroma vector store.
-    
-    Args:
-        uploaded_file_path: Path to the PDF file to process.
-        
-    Returns:
-        Chroma vector store containing embedded documents.
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+QUANTIZED_MODEL_DIR = "./models/bge-int8-onnx"
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+INDEX_COMPLETE_MARKER = ".index_complete"  # Written once a persisted store is fully built
+INDEX_VERSION = "2"  # Stored in the marker; bump whenever chunking or embeddings change
+MAX_PERSISTED_STORES = 10  # Unused stores kept on disk before the oldest are evicted
+EMBED_FLUSH_SIZE = 512  # Chunks buffered before each Chroma write
+
+
+class QuantizedBGEEmbeddings(Embeddings):
+    """BGE embeddings served from a dynamically quantized (INT8) ONNX model.
+
+    The model is exported and quantized once, then cached on disk so later
+    runs load the INT8 weights directly.
     """
 
-    def classify_section(text: str) -> str:
-        """Classify document section to optimize chunking parameters.
+    def __init__(self, model_dir: str = QUANTIZED_MODEL_DIR, batch_size: int = 128):
+        self.batch_size = batch_size
+        if not os.path.isfile(os.path.join(model_dir, QUANTIZED_MODEL_FILE)):
+            self._export_quantized(model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # Fast tokenizers are not safe for concurrent calls on one instance
+        self._tokenizer_lock = threading.Lock()
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=QUANTIZED_MODEL_FILE
+        )
+
+    @staticmethod
+    def _export_quantized(model_dir: str):
+        """Export BGE to ONNX and quantize it for VNNI int8 GEMMs.
+        
+        The model is built in a scratch directory and renamed into place, so
+        an interrupted export never leaves a half-written model_dir behind.
+        """
+        parent = os.path.dirname(os.path.abspath(model_dir))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".bge-int8-")
+        try:
+            model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL, export=True)
+            quantizer = ORTQuantizer.from_pretrained(model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+            quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(EMBEDDING_MODEL).save_pretrained(tmp_dir)
+            # Clear any leftover from an earlier interrupted run before swapping in
+            shutil.rmtree(model_dir, ignore_errors=True)
+            os.replace(tmp_dir, model_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _tokenize(self, batch: List[str]) -> dict:
+        """Tokenize one batch, padding only to its longest text."""
+        with self._tokenizer_lock:
+            return dict(self.tokenizer(
+                batch, padding=True, truncation=True, max_length=512, return_tensors="np"
+            ))
+
+    def _iter_tokenized(self, batches: List[List[str]]) -> Iterator[dict]:
+        """Yield tokenized batches, preparing the next one on a helper thread.
         
+        The caller runs the model on each yielded batch; ONNX Runtime releases
+        the GIL, so tokenizing batch N+1 overlaps inference on batch N.
+        """
+        if len(batches) == 1:
+            # Nothing to overlap (e.g. embed_query), so skip the thread
+            yield self._tokenize(batches[0])
+            return
+        with ThreadPoolExecutor(max_workers=1) as tokenizer_pool:
+            next_inputs = tokenizer_pool.submit(self._tokenize, batches[0])
+            for i in range(len(batches)):
+                inputs = next_inputs.result()
+                if i + 1 < len(batches):
+                    next_inputs = tokenizer_pool.submit(self._tokenize, batches[i + 1])
+                yield inputs
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of document chunks.
+
+        Texts are processed in fixed-size batches. The next batch is
+        tokenized on a helper thread while the model runs the current one.
+
         Args:
-            text: Content to classify.
-            
+            texts: Chunk texts to embed.
+
         Returns:
-            Section category for appropriate chunk sizing.
+            L2-normalized embedding for each text.
         """
-        t = text.lower()
-        if "management discussion" in t or "md&a" in t:
-            return "mdna"
-        if "risk" in t:
-            return "risk"
-        if "financial statement" in t or "balance sheet" in t:
-            return "financials"
-        if "notes to" in t:
-            return "notes"
-        if "notice" in t or "e-voting" in t or "agm" in t:
-            return "legal"
-        return "other"
-
-    # Load PDF documents
-    loader = PyMuPDFLoader(uploaded_file_path)
+        batches = [
+            texts[start:start + self.batch_size]
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        if not batches:
+            return []
+
+        # Pooled vectors are written straight into one FP32 matrix, which is
+        # then normalized in place and converted to lists in a single pass
+        embeddings = None
+        for i, inputs in enumerate(self._iter_tokenized(batches)):
+            outputs = self.model(**inputs)
+            # BGE uses the [CLS] token as the sentence embedding
+            cls = outputs.last_hidden_state[:, 0]
+            if embeddings is None:
+                embeddings = np.empty((len(texts), cls.shape[1]), dtype=np.float32)
+            start = i * self.batch_size
+            embeddings[start:start + len(cls)] = cls
+
+        # Normalize in FP32 regardless of the model's compute dtype
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single user query."""
+        return self.embed_documents([text])[0]
+
+
+@st.cache_resource(show_spinner=False)
+def get_embeddings() -> QuantizedBGEEmbeddings:
+    """Load the embedding model once per process and share it across sessions."""
+    return QuantizedBGEEmbeddings(batch_size=128)
+
+@st.cache_resource(show_spinner=False)
+def get_llm() -> ChatGroq:
+    """Create the Groq chat client once per process and share it across sessions."""
+    return ChatGroq(
+        model="openai/gpt-oss-20b",
+        temperature=0,  # Deterministic answers for financial analysis
+        streaming=True  # Streaming for real-time responses
+    )
+
+# Streamlit sessions share one process, so per-store locks serialize builds
+# of the same document, and the open set records stores that chromadb's
+# per-path client cache may still hold (those must never be deleted from disk)
+_store_locks: Dict[str, threading.Lock] = {}
+_opened_stores: Set[str] = set()
+_store_registry_lock = threading.Lock()
+
+def _store_lock(persist_directory: str) -> threading.Lock:
+    """Return the build lock for one persist directory."""
+    with _store_registry_lock:
+        return _store_locks.setdefault(os.path.abspath(persist_directory), threading.Lock())
+
+def _mark_opened(persist_directory: str):
+    """Record that a chromadb client for this directory exists in the process."""
+    with _store_registry_lock:
+        _opened_stores.add(os.path.abspath(persist_directory))
+
+def _evict_unused_stores(root: str):
+    """Delete the least recently used stores under root beyond MAX_PERSISTED_STORES.
+    
+    Only stores never opened by this process are candidates, so no live
+    chromadb client is left pointing at deleted files.
+    """
+    if not os.path.isdir(root):
+        return
+    # Held throughout so no store can be opened between selection and deletion
+    with _store_registry_lock:
+        candidates = []
+        for name in os.listdir(root):
+            path = os.path.abspath(os.path.join(root, name))
+            if os.path.isdir(path) and path not in _opened_stores:
+                marker = os.path.join(path, INDEX_COMPLETE_MARKER)
+                last_used = os.path.getmtime(marker if os.path.exists(marker) else path)
+                candidates.append((last_used, path))
+        candidates.sort(reverse=True)
+        for _, path in candidates[MAX_PERSISTED_STORES:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+def has_persisted_chroma(persist_directory: str) -> bool:
+    """Check whether a fully built, current-version store exists in persist_directory.
+    
+    Chroma creates the directory before any chunk is written, so only the
+    completion marker distinguishes a finished store from an interrupted one.
+    The marker holds INDEX_VERSION, so stores built by an older pipeline are
+    treated as missing and rebuilt.
+    """
     try:
-        docs = loader.load()
-    except Exception as e:
-        raise RuntimeError(f"Failed to parse PDF: {str(e)}")
+        with open(os.path.join(persist_directory, INDEX_COMPLETE_MARKER)) as f:
+            return f.read().strip() == INDEX_VERSION
+    except OSError:
+        return False
+
+def load_persisted_chroma(persist_directory: str) -> Chroma:
+    """Reopen a Chroma vector store previously built for the same document.
     
-    # Filter and classify sections
-    filtered_docs = []
-    for doc in docs:
-        section = classify_section(doc.page_content)
-        # Skip legal/notice pages - they add noise without analytical value
-        if section != "legal":
-            doc.metadata["section"] = section
-            filtered_docs.append(doc)
-    def get_chunk_params(section: str) -> Tuple[int, int]:
-        """Get optimal chunk size and overlap for document section.
+    Args:
+        persist_directory: Directory the store was persisted to.
         
-        Financial content requires larger chunks to preserve context.
-        """
-        if section in ["financials", "notes"]:
-            return 1800, 300  # Larger chunks for tables and numbers
-        return 1200, 150  # Standard chunks for narrative text
-
-    # Intelligently split documents based on section type
-    all_splits = []
-    for doc in filtered_docs:
-        chunk_size, overlap = get_chunk_params(doc.metadata["section"])
-        splitter = RecursiveCharacterTextSplitter(
-           chunk_size=chunk_size,
-            chunk_overlap=overlap
-        )
-        all_splits.extend(splitter.split_documents([doc]))
+    Returns:
+        Chroma vector store backed by the existing on-disk collection.
+    """
+    _mark_opened(persist_directory)
+    # Refresh the marker's mtime so eviction treats this store as recently used
+    os.utime(os.path.join(persist_directory, INDEX_COMPLETE_MARKER))
+    return Chroma(
+        persist_directory=persist_directory,
+        embedding_function=get_embeddings()
+    )
+
+def _add_in_batches(vectorstore: Chroma, page_splits: Iterable[List[Document]]):
+    """Buffer each page's chunks and write them to the store in batches."""
+    pending = []
+    for splits in page_splits:
+        pending.extend(splits)
+        if len(pending) >= EMBED_FLUSH_SIZE:
+            vectorstore.add_documents(pending)
+            pending = []
+    if pending:
+        vectorstore.add_documents(pending)
+
+def process_document_to_chroma(uploaded_file_path: str, persist_directory: Optional[str] = None):
+    """Load PDF, chunk intelligently, create Chroma vector store.
+    
+    Pages are parsed and split one at a time and streamed into the store
+    in batches instead of materializing every page's Document up front.
     
-    # Create embeddings using BGE model (optimized for financial text)
-    embeddings = HuggingFaceEmbeddings(model_name="BAAI/bge-small-en-v1.5")
+    Args:
+        uploaded_file_path: Path to the PDF file to process.
+        persist_directory: Optional directory to persist the store to, so an
+            identical upload can be reloaded with load_persisted_chroma.
+            Builds of the same directory are serialized, and leftovers from
+            an interrupted or older build there are discarded first.
+        
+    Returns:
+        Chroma vector store containing embedded documents.
+    """
+    if persist_directory is None:
+        return _build_chroma(uploaded_file_path, None)
+    with _store_lock(persist_directory):
+        # Another session may have finished this document while we waited
+        if has_persisted_chroma(persist_directory):
+            return load_persisted_chroma(persist_directory)
+        _evict_unused_stores(os.path.dirname(os.path.abspath(persist_directory)))
+        return _build_chroma(uploaded_file_path, persist_directory)
+
+def _build_chroma(uploaded_file_path: str, persist_directory: Optional[str]) -> Chroma:
+    """Parse, chunk and embed the PDF into a new (or reset) Chroma store."""
+    # Shared INT8-quantized BGE model (optimized for financial text)
+    embeddings = get_embeddings()
     
-    # Create in-memory Chroma vector store with embedded documents
-    vectorstore = Chroma.from_documents(
-        documents=all_splits,
-        embedding=embeddings
+    # Create Chroma vector store (in-memory unless persist_directory is set)
+    if persist_directory:
+        _mark_opened(persist_directory)
+    stale = persist_directory is not None and os.path.isdir(persist_directory)
+    vectorstore = Chroma(
+        embedding_function=embeddings,
+        persist_directory=persist_directory
     )
+    if stale:
+        # Drop chunks from an interrupted or older build through the client;
+        # deleting the files would strand chromadb's cached client for this path
+        vectorstore.reset_collection()
+
+    # Parsing is cheap next to embedding, so pages are read in-process from a
+    # single open document and streamed straight into batched writes
+    _add_in_batches(vectorstore, iter_page_splits(uploaded_file_path))
+
+    if persist_directory:
+        with open(os.path.join(persist_directory, INDEX_COMPLETE_MARKER), "w") as f:
+            f.write(INDEX_VERSION)
     return vectorstore
 
 def format_docs(docs: List) -> str:
@@ -102,10 +298,93 @@ def format_docs(docs: List) -> str:
     Returns:
         Formatted string with page numbers and content.
     """
-    return "\n\n---\n\n".join(
-        f"[Page {doc.metadata.get('page', '?')}]\n{doc.page_content}"
-        for doc in docs
-    )
+    # Fill one preallocated parts list (chunks and separators) and join once
+    parts = [None] * (2 * len(docs) - 1)
+    for i, doc in enumerate(docs):
+        if i:
+            parts[2 * i - 1] = "\n\n---\n\n"
+        parts[2 * i] = f"[Page {doc.metadata.get('page', '?')}]\n{doc.page_content}"
+    return "".join(parts)
+
+class MMRRetriever(BaseRetriever):
+    """Max marginal relevance retriever with vectorized diversity scoring.
+    
+    Fetches candidates from the HNSW index once, then computes all pairwise
+    similarities in a single matrix product instead of per-pair loops.
+    """
+
+    vectorstore: Chroma
+    k: int = 6  # Return top 6 relevant chunks
+    fetch_k: int = 20  # Fetch more candidates for diversity
+    lambda_mult: float = 0.7  # 70% relevance, 30% diversity
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vec = np.asarray(
+            self.vectorstore.embeddings.embed_query(query), dtype=np.float32
+        )
+        results = self.vectorstore._collection.query(
+            query_embeddings=[query_vec.tolist()],
+            n_results=self.fetch_k,
+            include=["documents", "metadatas", "embeddings"],
+        )
+        candidates = np.asarray(results["embeddings"][0], dtype=np.float32)
+        if len(candidates) == 0:
+            return []
+
+        # Embeddings are unit-length, so dot products are cosine similarities
+        query_sim = candidates @ query_vec
+        pairwise = candidates @ candidates.T
+
+        selected = [int(np.argmax(query_sim))]
+        max_sim = pairwise[selected[0]].copy()
+        while len(selected) < min(self.k, len(candidates)):
+            scores = self.lambda_mult * query_sim - (1 - self.lambda_mult) * max_sim
+            scores[selected] = -np.inf
+            idx = int(np.argmax(scores))
+            selected.append(idx)
+            np.maximum(max_sim, pairwise[idx], out=max_sim)
+
+        documents = results["documents"][0]
+        metadatas = results["metadatas"][0]
+        return [
+            Document(page_content=documents[i], metadata=metadatas[i] or {})
+            for i in selected
+        ]
+
+# Prompt templates are static, so they are built once at import time
+
+# Reformat follow-up questions using chat history
+# Example: "How did it change?" -> "How did the revenue change compared to last year?"
+CONTEXTUALIZE_Q_SYSTEM_PROMPT = (
+    "Given a chat history and the latest user question which might reference context in the chat history, "
+    "formulate a standalone question which can be understood without the chat history. "
+    "Do NOT answer the question, just reformulate it if needed and otherwise return it as is."
+)
+
+CONTEXTUALIZE_Q_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", CONTEXTUALIZE_Q_SYSTEM_PROMPT),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+])
+
+# Generate grounded answers from retrieved context
+QA_SYSTEM_PROMPT = (
+    "You are an expert Financial Analyst specializing in annual report analysis. "
+    "Use the retrieved context to answer questions about financial performance, risks, and strategy. "
+    "When analyzing tables, carefully examine rows and columns. "
+    "Expand financial terminology: 'revenue' includes 'total income', 'net sales', 'turnover'. "
+    "If the answer is not in the context, say 'I don't have this information in the document.' "
+    "Always be precise and cite specific figures when available.\n\n"
+    "Context:\n{context}"
+)
+
+QA_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", QA_SYSTEM_PROMPT),
+    MessagesPlaceholder("chat_history"),
+    ("human", "{input}"),
+])
 
 def get_rag_chain(vectorstore: Chroma):
     """Build history-aware RAG chain for answering financial questions.
@@ -116,59 +395,18 @@ def get_rag_chain(vectorstore: Chroma):
     Returns:
         Tuple of (history_aware_retriever, generation_chain).
     """
-    # Initialize LLM with streaming for real-time responses
-    llm = ChatGroq(
-        model="openai/gpt-oss-20b",
-        temperature=0,  # Deterministic answers for financial analysis
-        streaming=True
-    )
+    llm = get_llm()
     
     # MMR retriever balances relevance and diversity
-    retriever = vectorstore.as_retriever(
-        search_type="mmr",
-        search_kwargs={
-            "k": 6,  # Return top 6 relevant chunks
-            "fetch_k": 20,  # Fetch more candidates for diversity
-            "lambda_mult": 0.7  # 70% relevance, 30% diversity
-        }
-    )
+    retriever = MMRRetriever(vectorstore=vectorstore)
 
     # STEP 1: Reformat follow-up questions using chat history
-    # Example: "How did it change?" -> "How did the revenue change compared to last year?"
-    contextualize_q_system_prompt = (
-        "Given a chat history and the latest user question which might reference context in the chat history, "
-        "formulate a standalone question which can be understood without the chat history. "
-        "Do NOT answer the question, just reformulate it if needed and otherwise return it as is."
-    )
-    
-    contextualize_q_prompt = ChatPromptTemplate.from_messages([
-        ("system", contextualize_q_system_prompt),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ])
-    
+    # (with an empty history the query goes straight to the retriever, no LLM call)
     history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
+        llm, retriever, CONTEXTUALIZE_Q_PROMPT
     )
 
     # STEP 2: Generate grounded answers from retrieved context
-    system_prompt = (
-        "You are an expert Financial Analyst specializing in annual report analysis. "
-        "Use the retrieved context to answer questions about financial performance, risks, and strategy. "
-        "When analyzing tables, carefully examine rows and columns. "
-        "Expand financial terminology: 'revenue' includes 'total income', 'net sales', 'turnover'. "
-        "If the answer is not in the context, say 'I don't have this information in the document.' "
-        "Always be precise and cite specific figures when available.\n\n"
-        "Context:\n{context}"
-    )
-
-    qa_prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        MessagesPlaceholder("chat_history"),
-        ("human", "{input}"),
-    ])
-
-    # Compose the generation chain
-    generation_chain = qa_prompt | llm | StrOutputParser()
+    generation_chain = QA_PROMPT | llm | StrOutputParser()
     
     return history_aware_retriever, generation_chain
\ No newline at end of file
@@ -92,4 +92,13 @@ def render_sidebar_capabilities():
     - Risk Factors  
     - Management Discussion  
     - Strategy Insights  
-    """)
\ No newline at end of file
+    """)
+
+def render_sources(sources):
+    """Renders the (page, snippet) source list for one answer."""
+    with st.expander("View Sources"):
+        for i, (page, snippet) in enumerate(sources):
+            st.markdown(f"**Source {i+1}**")
+            st.caption(f"Page: {page}")
+            st.info(snippet)
+            st.divider()